@@ -1,15 +1,233 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import csv
+import functools
+import io
+import itertools
 import os
+import random
+import re
+import sqlite3
+import string
 import sys
-import pprint
+import time
+import urllib.parse
 
+import aiohttp
+from geopy.adapters import AioHTTPAdapter
 from geopy.geocoders import Bing
-from geopy.exc import GeocoderTimedOut, GeocoderServiceError
+from geopy.exc import (
+    GeocoderParseError, GeocoderRateLimited, GeocoderServiceError, GeocoderTimedOut, GeocoderUnavailable
+)
+import orjson
 import pandas as pd
-import requests
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 #------------------ CONFIGURATION -------------------------------
 BING_API_KEY = os.getenv('BING_API_KEY')
-BACKOFF_TIME = 30
+BACKOFF_TIME = 30  # Seconds before the first retry; doubles on each further attempt
+MAX_BACKOFF_TIME = 300  # Cap on the computed (not Retry-After) wait between retries
+MAX_RETRIES = 5
+CONCURRENCY = 8  # Max in-flight Bing geocode requests
+RATE_LIMIT = 20  # Bing requests started per second; halved on each 429, then recovers
+MIN_RATE_LIMIT = 1  # Floor for the rate after repeated 429s
+CENSUS_BATCH_SIZE = 1000  # Addresses per Census addressbatch upload (the API allows up to 10,000)
+CENSUS_CONCURRENCY = 16  # Max in-flight Census district requests
+BATCH_SIZE = 100  # Geocoded addresses handed to each district lookup task
+PROGRESS_INTERVAL = 50  # Print progress every this many geocoded addresses
+REQUEST_TIMEOUT = 10  # Seconds per Bing or Census coordinates request
+CENSUS_BATCH_READ_TIMEOUT = 600  # Seconds a Census batch upload may go without sending any data back
+CHUNK_SIZE = 50_000  # Input rows read, geocoded and saved at a time
+CACHE_FILENAME = "data/geocode_cache.sqlite"
+DISTRICT_MEMORY_CACHE_SIZE = 100_000  # Census lookups also kept in memory for the run
+CACHE_COMMIT_INTERVAL = 200  # Cache writes per SQLite transaction
+
+RESULT_COLUMNS = [
+    "formatted_address", "latitude", "longitude", "state", "county",
+    "city", "postal_code", "country", "confidence",
+    "state_senate_district", "state_house_district", "input_string"
+]
+NUMERIC_RESULT_COLUMNS = {"latitude", "longitude"}  # Saved as floats; the other result columns are strings
+
+#------------------ CACHING -------------------------------
+class Cache:
+    """Persistent key -> JSON result store backed by a SQLite table.
+
+    With memory_size set, the most recently used entries are also kept in an
+    in-memory LRU so repeated keys skip the SQLite query and JSON decode.
+    Writes are committed every CACHE_COMMIT_INTERVAL sets; caches in the same
+    file share one connection, whose owner commits and closes it at the end.
+    """
+
+    def __init__(self, conn, table, memory_size=0):
+        self.table = table
+        self.memory = collections.OrderedDict()
+        self.memory_size = memory_size
+        self.pending = 0
+        self.conn = conn
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, payload JSON, ts INTEGER)"
+        )
+
+    def get(self, key):
+        """Return the cached result for key, or None on a miss."""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        row = self.conn.execute(f"SELECT payload FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        result = orjson.loads(row[0])
+        self._remember(key, result)
+        return result
+
+    def set(self, key, result):
+        """Store result under key, replacing any existing entry."""
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, payload, ts) VALUES (?, ?, ?)",
+            (key, orjson.dumps(result).decode(), int(time.time())),
+        )
+        self.pending += 1
+        if self.pending >= CACHE_COMMIT_INTERVAL:
+            self.commit()
+        self._remember(key, result)
+
+    def commit(self):
+        """Commit any pending writes to disk."""
+        self.conn.commit()
+        self.pending = 0
+
+    def _remember(self, key, result):
+        if not self.memory_size:
+            return
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+#------------------ HTTP -------------------------------
+def get_backoff_time(attempt, retry_after=None):
+    """Seconds to wait before retrying after the given (0-based) failed attempt.
+
+    Uses the server's Retry-After value when it is a number of seconds, plus up
+    to 25% jitter. Otherwise uses exponential backoff from BACKOFF_TIME, scaled
+    by a random 0.5-1.5x so concurrent tasks don't retry in lockstep, then
+    capped at MAX_BACKOFF_TIME.
+    """
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        return min(MAX_BACKOFF_TIME, BACKOFF_TIME * 2 ** attempt * random.uniform(0.5, 1.5))
+    # Never retry sooner than the server asked
+    return delay + random.uniform(0, delay * 0.25)
+
+class TransientError(Exception):
+    """A request failed in a way worth retrying, such as a 429 or 5xx response."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# geopy wraps Bing's timeouts and connection failures; the aiohttp ones come from Census requests
+RETRYABLE_ERRORS = (
+    TransientError, GeocoderRateLimited, GeocoderTimedOut, GeocoderUnavailable,
+    asyncio.TimeoutError, aiohttp.ClientConnectionError,
+)
+
+def retry(retries=MAX_RETRIES):
+    """Decorate a coroutine function to retry RETRYABLE_ERRORS, waiting get_backoff_time between attempts."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in itertools.count():
+                try:
+                    return await func(*args, **kwargs)
+                except RETRYABLE_ERRORS as e:
+                    if attempt >= retries:
+                        raise
+                    await asyncio.sleep(get_backoff_time(attempt, getattr(e, "retry_after", None)))
+        return wrapper
+    return decorator
+
+class AsyncTokenBucket:
+    """Token bucket that paces request starts to an adaptive rate per second.
+
+    Up to capacity requests can start back to back after an idle spell.
+    throttle() halves the rate (down to min_rate) when the server pushes back,
+    and each recover() call wins back 5% of the original rate.
+    """
+
+    def __init__(self, rate, capacity, min_rate=MIN_RATE_LIMIT):
+        self.max_rate = self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a request may start, then take a token for it."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def recover(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+class SharedSessionAdapter(AioHTTPAdapter):
+    """geopy adapter that sends geocoder requests over an existing aiohttp session.
+
+    Lets the Bing and Census requests share one keep-alive connection pool.
+    The session is owned, and closed, by the caller. Responses are parsed
+    with orjson.
+    """
+
+    def __init__(self, session, **kwargs):
+        super().__init__(**kwargs)
+        self.__dict__["session"] = session
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def get_json(self, url, *, timeout, headers):
+        with self._normalize_exceptions():
+            async with self._request(url, timeout=timeout, headers=headers) as resp:
+                await self._raise_for_status(resp)
+                body = await resp.read()
+                try:
+                    return orjson.loads(body)
+                except orjson.JSONDecodeError:
+                    raise GeocoderParseError(f"Could not deserialize using deserializer:\n{body!r}")
+
+# Plain pattern strings rather than compiled re objects, so pandas can run them in Arrow (RE2)
+_PUNCTUATION_PATTERN = f"[{re.escape(string.punctuation)}]"
+# RE2's \s is ASCII-only, so \p{Z} picks up non-breaking and other Unicode spaces
+_WHITESPACE_PATTERN = r"[\s\p{Z}]+"
+
+def normalize_addresses(addresses):
+    """Normalize a Series of addresses into cache keys (case, whitespace and punctuation insensitive).
+
+    Runs as vectorized Arrow string kernels over the whole Series.
+    """
+    return (
+        addresses.astype("string[pyarrow]")
+        .str.replace(_PUNCTUATION_PATTERN, " ", regex=True)
+        .str.lower()
+        .str.replace(_WHITESPACE_PATTERN, " ", regex=True)
+        .str.strip()
+    )
 
 #------------------ FILE HANDLING -------------------------------
 def get_input_filename():
@@ -20,18 +238,36 @@ def get_input_filename():
         sys.exit(1)
     return input_filename
 
-def get_output_filename(input_filename):
-    """Generate the output filename based on the input filename."""
+def get_output_filename(input_filename, output_format="csv"):
+    """Generate the output filename based on the input filename and output format."""
     input_basename = os.path.basename(input_filename)
     input_name, _ = os.path.splitext(input_basename)
-    return f"data/output-{input_name}.csv"
+    return f"data/output-{input_name}.{output_format}"
+
+def normalize_columns(data):
+    """Strip a leading BOM and surrounding whitespace from column names in place."""
+    columns = [col.strip() for col in data.columns]
+    if columns:
+        # Only the first column can carry a BOM; read as cp1252 a UTF-8 BOM shows up as "ï»¿"
+        columns[0] = columns[0].lstrip("\ufeff").removeprefix("\ufeff".encode("utf-8").decode("cp1252")).strip()
+    data.columns = columns
+    return data
+
+def load_header(input_filename):
+    """Load just the header row of the CSV file into an empty DataFrame."""
+    return normalize_columns(pd.read_csv(input_filename, encoding="cp1252", nrows=0))
 
 def load_data(input_filename, testing=False):
-    """Load CSV data into a Pandas DataFrame."""
+    """Load CSV data as an iterator of DataFrame chunks of up to CHUNK_SIZE rows."""
     nrows = 5 if testing else None
-    data = pd.read_csv(input_filename, encoding="cp1252", low_memory=False, dtype=str, nrows=nrows)
-    data.columns = [col.encode('utf-8').decode('utf-8-sig').strip() for col in data.columns]  # Normalize column names
-    return data
+    # The pyarrow engine can't read in chunks, pad short rows or rename duplicate
+    # headers, but the columns keep Arrow-backed strings
+    chunks = pd.read_csv(
+        input_filename, encoding="cp1252", dtype="string[pyarrow]", nrows=nrows, chunksize=CHUNK_SIZE,
+        memory_map=True,
+    )
+    for data in chunks:
+        yield normalize_columns(data)
 
 def get_address_columns(data):
     """Display available columns and prompt user for address-related columns."""
@@ -54,98 +290,271 @@ def get_address_columns(data):
 
     return address_columns
 
+def get_state_filter(data):
+    """Prompt for an optional state to restrict geocoding to.
+
+    Returns (state column, state abbreviation), or None to geocode every row.
+    Only offered when the input has a column named "state".
+    """
+    state_column = next((col for col in data.columns if col.lower() == "state"), None)
+    if state_column is None:
+        return None
+
+    state = input("Restrict geocoding to state abbrev? [MN/none]: ").strip().upper()
+    if state in ("", "NONE"):
+        return None
+
+    print(f"\nOnly geocoding rows where {state_column} is {state}")
+    return state_column, state
+
 def combine_address_columns(data, address_columns):
-    """If multiple columns are selected, combine them into a full address field."""
+    """If multiple columns are selected, combine them into a full address field.
+
+    Missing parts are left out, so a row with none of them gets an empty address.
+    """
     if len(address_columns) > 1:
-        data["Full_Address"] = data[address_columns].astype(str).agg(", ".join, axis=1)
+        first, *rest = (data[col].astype("string[pyarrow]") for col in address_columns)
+        # Joined as missing-as-empty, then the separators around empty parts are dropped
+        data["Full_Address"] = (
+            first.str.cat(rest, sep=", ", na_rep="")
+            .str.replace(r"^(, )+|(, )+$", "", regex=True)
+            .str.replace(r"(, ){2,}", ", ", regex=True)
+        )
         return "Full_Address"
     return address_columns[0]
 
-def save_results(results, output_filename, original_data):
-    """Save the geocoding results to a CSV file."""
-    results_df = pd.DataFrame(results)
+class CSVOutput:
+    """Output file that DataFrame chunks are appended to as CSV.
 
-    merged_df = original_data.copy()
-    merged_df = pd.concat([merged_df, results_df], axis=1)
+    The file is opened once for the whole run and flushed after every chunk,
+    so what's on disk is always complete up to the last chunk written. Chunks
+    are serialized by pyarrow's C++ CSV writer rather than DataFrame.to_csv.
+    """
 
-    new_columns = [
-        "formatted_address", "latitude", "longitude", "state", "county",
-        "city", "postal_code", "country", "confidence",
-        "state_senate_district", "state_house_district", "input_string"
-    ]
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "wb")
+        self.header = True
 
-    all_columns = list(original_data.columns) + [col for col in new_columns if col not in original_data.columns]
+    def write(self, data):
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        pa_csv.write_csv(table, self.file, write_options=pa_csv.WriteOptions(include_header=self.header))
+        self.file.flush()
+        self.header = False
 
-    merged_df = merged_df[all_columns]
-    print(f"\nResults saved to: {output_filename}")
+    def close(self):
+        self.file.close()
 
-    merged_df.to_csv(output_filename, encoding="utf8", index=False)
+class ParquetOutput:
+    """Output file that DataFrame chunks are appended to as zstd-compressed Parquet.
 
-#------------------ GEOCODING FUNCTIONS -------------------------------
-def get_census_legislative_districts(lat, lng):
-    """Query the U.S. Census API to get state legislative districts based on lat/lng."""
-    url = "https://geocoding.geo.census.gov/geocoder/geographies/coordinates"
-    params = {
-        "x": lng,
-        "y": lat,
-        "benchmark": "Public_AR_Current",
-        "vintage": "Current_Current",
-#        "layers": "50,54",  # 50 = SD, 54 = HD -- skip for now
-        "format": "json",
-    }
+    The schema comes from the first chunk's dtypes. save_results gives every
+    column an explicit Arrow-backed dtype, so all chunks share it.
+    """
 
-    response = requests.get(url, params=params)
-    data = response.json()
+    def __init__(self, filename):
+        self.filename = filename
+        self.writer = None
 
-    state_senate = None
-    state_house = None
-    state_code = None
+    def write(self, data):
+        # Imported here so CSV runs don't pay for loading pyarrow.parquet
+        import pyarrow.parquet as pq
 
-    # Extract state code from the 'States' layer if available
-    if "result" in data and "geographies" in data["result"]:
-        geographies = data["result"]["geographies"]
-
-        if "States" in geographies:
-            state_info = geographies["States"][0]
-            state_code = str(state_info.get("STATE"))
+        if self.writer is None:
+            table = pa.Table.from_pandas(data, preserve_index=False)
+            self.writer = pq.ParquetWriter(self.filename, table.schema, compression="zstd")
+        else:
+            table = pa.Table.from_pandas(data, schema=self.writer.schema, preserve_index=False)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+OUTPUT_FORMATS = {"csv": CSVOutput, "parquet": ParquetOutput}
+
+def valid_address_mask(addresses):
+    """Return a boolean mask of the addresses that are worth geocoding (not missing, blank or "nan")."""
+    stripped = addresses.astype("string").str.strip()
+    return stripped.notna() & (stripped != "") & (stripped.str.lower() != "nan")
+
+def save_results(results, output, original_data):
+    """Add the geocoding result columns to the input data in place and append it to the output.
+
+    A result column whose name is already an input column (e.g. "state") is
+    saved as "geocoded_<name>", so both are kept and column names stay unique.
+    """
+    input_columns = set(original_data.columns)
+    # Assigned onto the chunk itself; assign() would deep-copy every input column first
+    for col, values in results.items():
+        name = f"geocoded_{col}" if col in input_columns else col
+        dtype = "float64[pyarrow]" if col in NUMERIC_RESULT_COLUMNS else "string[pyarrow]"
+        original_data[name] = pd.array(values, dtype=dtype)
+    output.write(original_data)
 
-        # Dynamically find the correct keys for legislative districts
-        house_key = next((key for key in geographies if "State Legislative Districts - Lower" in key), None)
-        senate_key = next((key for key in geographies if "State Legislative Districts - Upper" in key), None)
+#------------------ GEOCODING FUNCTIONS -------------------------------
+@retry()
+async def fetch_census_json(session, url, params):
+    """GET a Census geocoder URL and decode its JSON response."""
+    async with session.get(url, params=params) as response:
+        if response.status == 429 or response.status >= 500:
+            raise TransientError(
+                f"Census returned HTTP {response.status}", retry_after=response.headers.get("Retry-After")
+            )
+        response.raise_for_status()
+        # Decode straight from bytes; response.json() would build a str first
+        return orjson.loads(await response.read())
+
+# The static query params are encoded once; aiohttp appends the per-request coordinates
+CENSUS_COORDINATES_URL = "https://geocoding.geo.census.gov/geocoder/geographies/coordinates?" + urllib.parse.urlencode({
+    "benchmark": "Public_AR_Current",
+    "vintage": "Current_Current",
+#    "layers": "50,54",  # 50 = SD, 54 = HD -- skip for now
+    "format": "json",
+})
+
+def district_key(lat, lng):
+    """Return the district cache key for a coordinate; nearby coordinates (~1m apart) share one."""
+    return f"{round(lat, 5)},{round(lng, 5)}"
+
+async def get_census_legislative_districts(lat, lng, session, cache):
+    """Query the U.S. Census API to get state legislative districts based on lat/lng."""
+    key = district_key(lat, lng)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
 
-        # Extract House District
-        if house_key and geographies.get(house_key):
-            house_info = geographies[house_key][0]
-            state_house = house_info.get("BASENAME")
+    data = await fetch_census_json(session, CENSUS_COORDINATES_URL, {"x": lng, "y": lat})
 
-        # Extract Senate District
-        if senate_key and geographies.get(senate_key):
-            senate_info = geographies[senate_key][0]
-            state_senate = senate_info.get("BASENAME")
+    geographies = data.get("result", {}).get("geographies", {})
 
-    if state_code != "27":
-        state_senate = "Not Minnesota"
+    # Extract state code from the 'States' layer if available
+    states = geographies.get("States")
+    state_code = str(states[0].get("STATE")) if states else None
 
-    return {
+    state_senate = None
+    state_house = None
+    # Only Minnesota districts are wanted; anything else is left empty
+    if state_code == "27":
+        # Layer names carry the district vintage (e.g. "2022 State Legislative
+        # Districts - Lower"), so match on the suffix in one pass
+        for layer, features in geographies.items():
+            if not features:
+                continue
+            if "State Legislative Districts - Lower" in layer:
+                state_house = features[0].get("BASENAME")
+            elif "State Legislative Districts - Upper" in layer:
+                state_senate = features[0].get("BASENAME")
+
+    district_data = {
         "state_senate_district": state_senate,
         "state_house_district": state_house,
     }
+    cache.set(key, district_data)
+    return district_data
+
+async def census_batch_geocode(addresses, session):
+    """Geocode a list of addresses with one Census addressbatch upload.
+
+    Returns a dict of address -> result for the addresses the Census matched;
+    the rest are left for Bing. Each address is sent whole in the street field.
+    """
+    upload = io.StringIO()
+    writer = csv.writer(upload)
+    for i, address in enumerate(addresses):
+        writer.writerow([i, address, "", "", ""])
+
+    form = aiohttp.FormData()
+    form.add_field("benchmark", "Public_AR_Current")
+    form.add_field("addressFile", upload.getvalue(), filename="addresses.csv", content_type="text/csv")
+
+    url = "https://geocoding.geo.census.gov/geocoder/locations/addressbatch"
+    # Batches can take minutes as a whole, so only connecting and stalled reads are bounded
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT, sock_read=CENSUS_BATCH_READ_TIMEOUT)
+    async with session.post(url, data=form, timeout=timeout) as response:
+        response.raise_for_status()
+        text = await response.text()
+
+    matches = pd.read_csv(
+        io.StringIO(text), header=None, dtype=str,
+        names=["id", "input", "match", "match_type", "matched_address", "coordinates", "tiger_line_id", "side"],
+    )
+    matches = matches[matches["match"] == "Match"]
+
+    results = {}
+    for row in matches.itertuples(index=False):
+        address = addresses[int(row.id)]
+        lng, lat = (float(value) for value in row.coordinates.split(","))
+        # Matched addresses look like "4600 SILVER HILL RD, WASHINGTON, DC, 20233"
+        *_, city, state, postal_code = [None, None, None] + row.matched_address.split(", ")
+        results[address] = {
+            "formatted_address": row.matched_address,
+            "latitude": lat,
+            "longitude": lng,
+            "state": state,
+            "county": None,
+            "city": city,
+            "postal_code": postal_code,
+            "country": "United States",
+            "confidence": row.match_type,
+            "state_senate_district": None,
+            "state_house_district": None,
+            "input_string": address,
+        }
+    return results
+
+async def prefill_cache_from_census(addresses_by_key, session, geocode_cache):
+    """Geocode the uncached addresses through the Census batch API and cache the matches.
+
+    Takes a dict of cache key -> address. Addresses the Census can't match stay
+    uncached, so get_results sends them to Bing.
+    """
+    keys_by_address = {address: key for key, address in addresses_by_key.items() if geocode_cache.get(key) is None}
+    misses = list(keys_by_address)
+    matched = 0
+    for start in range(0, len(misses), CENSUS_BATCH_SIZE):
+        try:
+            results = await census_batch_geocode(misses[start:start + CENSUS_BATCH_SIZE], session)
+        except Exception as e:
+            print(f"Error batch geocoding with the Census, falling back to Bing: {e}")
+            continue
+        for address, result in results.items():
+            geocode_cache.set(keys_by_address[address], result)
+        matched += len(results)
+    print(f"Census batch matched {matched} of {len(misses)} uncached addresses")
+
+# Shared template for addresses with no geocoding result
+_EMPTY_RESULT = dict.fromkeys(RESULT_COLUMNS)
+
+def empty_result(address):
+    """Return a result dict for an address that couldn't be geocoded."""
+    return {**_EMPTY_RESULT, "input_string": address}
+
+@retry()
+async def geocode_with_retries(geocode, address):
+    """Geocode an address with Bing, retrying rate-limited and transient failures."""
+    return await geocode(address, exactly_one=True)
+
+async def get_results(address, key, geocode, geocode_cache):
+    """Geocode an address using Bing Maps API, caching the result under key.
+
+    District fields are left empty; they are filled in afterwards for the whole
+    batch by add_legislative_districts.
+    """
+    cached = geocode_cache.get(key)
+    if cached is not None:
+        return {**cached, "input_string": address}
 
-def get_results(address, geolocator):
-    """Geocode an address using Bing Maps API and get state legislative districts."""
     try:
-        location = geolocator.geocode(address, exactly_one=True)
+        location = await geocode_with_retries(geocode, address)
 
         if location:
-            #pprint.pprint(location.raw)  # Debugging: Print full geocode response
+            #print(location.raw)  # Debugging: Print full geocode response
 
             # Extract lat/lng
             lat, lng = location.latitude, location.longitude
 
-            # Query Census API for legislative districts
-            district_data = get_census_legislative_districts(lat, lng)
-
-            return {
+            result = {
                 "formatted_address": location.address,
                 "latitude": lat,
                 "longitude": lng,
@@ -155,77 +564,249 @@ def get_results(address, geolocator):
                 "postal_code": location.raw.get("address", {}).get("postalCode"),
                 "country": location.raw.get("address", {}).get("countryRegion"),
                 "confidence": location.raw.get("confidence"),
-                "state_senate_district": district_data["state_senate_district"],
-                "state_house_district": district_data["state_house_district"],
-                "input_string": address,
-            }
-
-        else:
-            return {
-                "formatted_address": None,
-                "latitude": None,
-                "longitude": None,
-                "state": None,
-                "county": None,
-                "city": None,
-                "postal_code": None,
-                "country": None,
-                "confidence": None,
                 "state_senate_district": None,
                 "state_house_district": None,
                 "input_string": address,
             }
 
+        else:
+            result = empty_result(address)
+
+        geocode_cache.set(key, result)
+        return result
+
     except (GeocoderTimedOut, GeocoderServiceError) as e:
         print(f"Error geocoding '{address}': {e}")
 
-        return {
-            "formatted_address": None,
-            "latitude": None,
-            "longitude": None,
-            "state": None,
-            "county": None,
-            "city": None,
-            "postal_code": None,
-            "country": None,
-            "confidence": None,
-            "state_senate_district": None,
-            "state_house_district": None,
-            "input_string": address,
-        }
+        return empty_result(address)
+
+async def add_legislative_districts(results, session, cache, semaphore):
+    """Fill in state legislative districts for a batch of geocoded results.
+
+    Census lookups run concurrently, bounded by semaphore (shared by every
+    batch in flight), and are written back into the result dicts in place.
+    Results that share a district_key are looked up once. Results Bing
+    already places outside Minnesota skip the Census call and keep empty
+    districts.
+    """
+    async def bound_census(results_at_point):
+        lat, lng = results_at_point[0]["latitude"], results_at_point[0]["longitude"]
+        async with semaphore:
+            try:
+                district_data = await get_census_legislative_districts(lat, lng, session, cache)
+            except Exception as e:
+                print(f"Error getting legislative districts for '{results_at_point[0]['input_string']}': {e}")
+                return
+        for result in results_at_point:
+            result.update(district_data)
+
+    results_by_point = {}
+    for result in results:
+        if result["latitude"] is None:
+            continue
+        if result["state"] not in (None, "MN"):
+            continue
+        results_by_point.setdefault(district_key(result["latitude"], result["longitude"]), []).append(result)
+
+    tasks = [asyncio.create_task(bound_census(results_at_point)) for results_at_point in results_by_point.values()]
+    await asyncio.gather(*tasks)
+
+@contextlib.asynccontextmanager
+async def open_clients():
+    """Open the aiohttp session and rate-limited Bing geocode function shared by a whole run.
+
+    Yields (session, geocode). Both Bing and Census requests go through the
+    session's keep-alive connection pool, which is sized to the concurrency
+    limits so no request waits on, or opens, a socket beyond them.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=CONCURRENCY + CENSUS_CONCURRENCY,
+        limit_per_host=max(CONCURRENCY, CENSUS_CONCURRENCY),
+        keepalive_timeout=60,
+        ttl_dns_cache=300,
+    )
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        adapter_factory = functools.partial(SharedSessionAdapter, session)
+        async with Bing(api_key=BING_API_KEY, timeout=REQUEST_TIMEOUT, adapter_factory=adapter_factory) as geolocator:
+            bucket = AsyncTokenBucket(RATE_LIMIT, capacity=CONCURRENCY)
+
+            # Paces request starts; retries are left to geocode_with_retries, which honors Retry-After
+            async def geocode(*args, **kwargs):
+                await bucket.acquire()
+                try:
+                    location = await geolocator.geocode(*args, **kwargs)
+                except GeocoderRateLimited:
+                    bucket.throttle()
+                    raise
+                bucket.recover()
+                return location
+
+            yield session, geocode
+
+async def geocode_addresses(addresses, valid, session, geocode, geocode_cache, district_cache, census_batch=False):
+    """Geocode a Series of addresses concurrently, returning the results in input order.
+
+    Results are returned as a dict of RESULT_COLUMNS lists rather than a list
+    of per-row dicts. Only rows selected by the boolean mask ``valid`` are
+    geocoded; the rest get empty results. Addresses that normalize to the
+    same key are geocoded once, using the first such address, and the result
+    is copied to every matching row (each keeps its own input_string). With
+    census_batch, addresses are tried against the Census batch geocoder
+    before Bing.
+    """
+    columns = {col: [None] * len(addresses) for col in RESULT_COLUMNS}
+    columns["input_string"] = input_strings = addresses.tolist()
+    # Every other column is filled from the geocoding results
+    geocoded_columns = [col for col in RESULT_COLUMNS if col != "input_string"]
+    rows_by_key = {}
+    for index, key in zip(valid.to_numpy().nonzero()[0], normalize_addresses(addresses[valid]).tolist()):
+        rows_by_key.setdefault(key, []).append(index)
+    addresses_by_key = {key: input_strings[rows[0]] for key, rows in rows_by_key.items()}
+    print(f"Total unique addresses: {len(addresses_by_key)}")
+
+    geocoded = 0
+
+    if census_batch:
+        await prefill_cache_from_census(addresses_by_key, session, geocode_cache)
+
+    async def geocode_one(index, key, address):
+        nonlocal geocoded
+        try:
+            #print(f"Processing address {index+1}/{len(addresses_by_key)}: {address}") # debugging: print each address as processed
+            result = await get_results(address, key, geocode, geocode_cache)
+        except Exception as e:
+            print(f"Error processing address '{address}': {e}")
+            result = empty_result(address)
+        geocoded += 1
+        if geocoded % PROGRESS_INTERVAL == 0:
+            print(f"Geocoded {geocoded}/{len(addresses_by_key)} unique addresses")
+        return result
+
+    census_semaphore = asyncio.Semaphore(CENSUS_CONCURRENCY)
+
+    async def finish_batch(batch):
+        await add_legislative_districts([result for _, result in batch], session, district_cache, census_semaphore)
+
+        # Column by column, so each value is looked up once however many rows share it
+        for col in geocoded_columns:
+            column = columns[col]
+            for rows, result in batch:
+                value = result.get(col)
+                for row in rows:
+                    column[row] = value
+
+    finished = []  # (rows, result) pairs geocoded with Bing but not yet given districts
+    finishing = []
+
+    def flush():
+        """Hand the finished results to a new district lookup task."""
+        if finished:
+            finishing.append(asyncio.create_task(finish_batch(finished[:])))
+            finished.clear()
+
+    async def worker(pending):
+        for index, (key, rows) in pending:
+            finished.append((rows, await geocode_one(index, key, addresses_by_key[key])))
+            if len(finished) >= BATCH_SIZE:
+                flush()
+
+    # A sliding window: CONCURRENCY workers pull from one shared iterator, so an
+    # address stuck in retry backoff only holds up its own worker. District
+    # lookups for every BATCH_SIZE finished addresses overlap further Bing calls.
+    pending = enumerate(rows_by_key.items())
+    await asyncio.gather(*(worker(pending) for _ in range(CONCURRENCY)))
+    flush()
+    await asyncio.gather(*finishing)
+
+    return columns
+
+async def geocode_file(
+    input_filename, address_columns, output, geocode_cache, district_cache, census_batch=False, state_filter=None
+):
+    """Geocode the input file chunk by chunk, appending each chunk to the output.
+
+    One session and geocoder are shared across all chunks. With state_filter
+    (a (column, abbreviation) pair from get_state_filter), rows in other
+    states are written out with empty results and never sent to Bing or the
+    Census. Each chunk is saved in a worker thread while the next one is
+    geocoded. Returns the (total rows, addresses geocoded) counts.
+    """
+    total_rows = 0
+    total_addresses = 0
+    saving = None
+    async with open_clients() as (session, geocode):
+        try:
+            for data in load_data(input_filename):
+                address_column_name = combine_address_columns(data, address_columns)
+                addresses = data[address_column_name]
+                valid = valid_address_mask(addresses)
+                if state_filter is not None:
+                    state_column, state = state_filter
+                    valid &= (data[state_column].str.strip().str.upper() == state).fillna(False)
+
+                print(f"\nProcessing rows {total_rows + 1}-{total_rows + len(data)}")
+                total_rows += len(data)
+                total_addresses += int(valid.sum())
+
+                results = await geocode_addresses(
+                    addresses, valid, session, geocode, geocode_cache, district_cache, census_batch=census_batch
+                )
+
+                # Only one save runs at a time, so chunks reach the output in order
+                if saving is not None:
+                    await saving
+                print(f"Saving {len(addresses)} results to {output.filename}")
+                saving = asyncio.create_task(asyncio.to_thread(save_results, results, output, data))
+        finally:
+            if saving is not None:
+                await saving
+
+    return total_rows, total_addresses
 
 # ------------------ MAIN EXECUTION -----------------------------
+def parse_args():
+    """Parse command-line options."""
+    parser = argparse.ArgumentParser(description="Batch geocode the addresses in a CSV file.")
+    parser.add_argument(
+        "--format", choices=OUTPUT_FORMATS, default="csv", help="output file format (default: csv)"
+    )
+    parser.add_argument(
+        "--census-batch", action="store_true",
+        help="geocode US addresses with the Census batch geocoder first, using Bing only for unmatched ones",
+    )
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
     input_filename = get_input_filename()
-    output_filename = get_output_filename(input_filename)
-    data = load_data(input_filename)
+    output_filename = get_output_filename(input_filename, args.format)
 
-    address_columns = get_address_columns(data)
-    address_column_name = combine_address_columns(data, address_columns)
+    header = load_header(input_filename)
+    address_columns = get_address_columns(header)
+    state_filter = get_state_filter(header)
 
     print(f"\nUsing address column(s): {address_columns}")
     print(f"\nOutput file will be saved as: {output_filename}")
 
-    print(f"Total rows in input file: {len(data)}")
-    print(f"Total non-empty addresses: {len(data[address_column_name].dropna())}")
-
-    addresses = data[address_column_name].tolist()
-    geolocator = Bing(api_key=BING_API_KEY, timeout=10)
-    results = []
-    for index, address in enumerate(addresses):
-        try:
-            #print(f"Processing address {index+1}/{len(addresses)}: {address}") # debugging: print each address as processed
-            result = get_results(address, geolocator)
-            results.append(result)
-        except Exception as e:
-            print(f"Error processing address '{address}': {e}")
-            results.append({
-                "formatted_address": None, "latitude": None, "longitude": None,
-                "state_senate_district": None, "state_house_district": None, "input_string": address
-            })
-    print(f"Saving {len(results)} results to {output_filename}")
-
-    save_results(results, output_filename, data)
+    output = OUTPUT_FORMATS[args.format](output_filename)
+    cache_conn = sqlite3.connect(CACHE_FILENAME)
+    geocode_cache = Cache(cache_conn, "geocode")
+    district_cache = Cache(cache_conn, "districts", memory_size=DISTRICT_MEMORY_CACHE_SIZE)
+    try:
+        total_rows, total_addresses = asyncio.run(geocode_file(
+            input_filename, address_columns, output, geocode_cache, district_cache,
+            census_batch=args.census_batch, state_filter=state_filter,
+        ))
+    finally:
+        output.close()
+        cache_conn.commit()
+        cache_conn.close()
+
+    print(f"\nTotal rows in input file: {total_rows}")
+    print(f"Total addresses geocoded: {total_addresses}")
+    print(f"Results saved to: {output_filename}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file